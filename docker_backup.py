@@ -2,13 +2,109 @@
 Provides backup solutions for various types of containers
 """
 import abc
+import concurrent.futures
+import contextlib
 import gzip
+import logging
 import os
+import queue
+import threading
 import datetime
+import functools
+import io
+import itertools
+import re
+import shlex
+import tarfile
 import time
+import zlib
+from typing import Iterable
 import docker
 from docker.models.containers import Container
 
+try:
+    from isal import igzip as gzip_impl
+except ImportError:
+    gzip_impl = gzip
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESS_LEVEL = 1
+ZSTD_LEVEL = 3
+ZSTD_THREADS = 4
+CHUNK_SIZE = 1 << 20
+MAGIC = {"gz": b"\x1f\x8b", "zst": b"\x28\xb5\x2f\xfd"}
+DEFAULT_CODEC = "zst" if zstd is not None else "gz"
+
+# Shell snippets setting $zcmd to the best compressor for each codec available
+# in a container, $sfx to the resulting file suffix and compress() to run it.
+# zst falls back to gzip, which the host transcodes, since most images lack zstd.
+# Both fall back to passing data through uncompressed so the host can compress it.
+COMPRESS_FUNCTIONS = {
+    "gz": f'''
+if command -v pigz >/dev/null 2>&1; then
+    zcmd="pigz -{COMPRESS_LEVEL} -p 4"; sfx=.gz
+elif command -v gzip >/dev/null 2>&1; then
+    zcmd="gzip -{COMPRESS_LEVEL}"; sfx=.gz
+else
+    zcmd=cat; sfx=
+fi
+compress() {{ $zcmd; }}
+'''.strip(),
+    "zst": f'''
+if command -v zstd >/dev/null 2>&1; then
+    zcmd="zstd -q -c -{ZSTD_LEVEL} -T{ZSTD_THREADS}"; sfx=.zst
+elif command -v pigz >/dev/null 2>&1; then
+    zcmd="pigz -{COMPRESS_LEVEL} -p 4"; sfx=.gz
+elif command -v gzip >/dev/null 2>&1; then
+    zcmd="gzip -{COMPRESS_LEVEL}"; sfx=.gz
+else
+    zcmd=cat; sfx=
+fi
+compress() {{ $zcmd; }}
+'''.strip(),
+}
+
+RUN_TIMESTAMP = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+@functools.lru_cache(maxsize=1)
+def client():
+    """
+    Return docker client shared by all strategies
+    """
+    return docker.from_env()
+
+@functools.lru_cache(maxsize=1)
+def all_containers():
+    """
+    Return running containers, listed once per run
+    """
+    return client().containers.list()
+
+@functools.lru_cache(maxsize=None)
+def ensure_dir(path: str):
+    """
+    Create path if it does not exist yet
+    """
+    os.makedirs(path, exist_ok=True)
+
+def resolve_codec(codec: str):
+    """
+    Return codec if it can be written on this host, falling back to gz for zst
+    """
+    if codec not in COMPRESS_FUNCTIONS:
+        raise ValueError(f"Unknown codec: {codec}")
+    if codec == "zst" and zstd is None:
+        logger.warning("zstandard is not installed, falling back to gzip")
+        return "gz"
+
+    return codec
+
 def merge_keywords(keywords: list[str] | None, custom_keywords: list[str] | None):
     """
     Merge keywords lists or return other if one is None
@@ -23,39 +119,271 @@ def merge_keywords(keywords: list[str] | None, custom_keywords: list[str] | None
 def parse_env(container: Container):
     """
     Return dict of parsed envars for container
-    """
-    unparsed_env = container.exec_run("env") \
-        .output.decode("utf-8") \
-        .split("\n")
 
-    parsed = {}
-    for pair in unparsed_env:
-        pair_s = pair.split("=")
+    Read from the container's inspect data when present, which needs no exec.
+    The result is cached on the container.
+    """
+    parsed = getattr(container, "_parsed_env", None)
+    if parsed is not None:
+        return parsed
 
-        if len(pair_s) != 2:
-            continue
+    env_list = container.attrs.get("Config", {}).get("Env")
+    if env_list:
+        lines = [line.encode("utf-8") for line in env_list]
+    else:
+        lines = container.exec_run("env").output.splitlines()
 
-        parsed[pair_s[0]] = pair_s[1]
+    parsed = {}
+    for line in lines:
+        key, sep, value = line.partition(b"=")
+        if sep:
+            parsed[key.decode("utf-8")] = value.decode("utf-8")
 
+    container._parsed_env = parsed # pylint: disable=protected-access
     return parsed
 
 def format_file_path(backup_dir: str, name: str, extension: str):
     """
-    Append ISO8601 timestamp to given name/extension at backup_dir
+    Append the run's ISO8601 timestamp to given name/extension at backup_dir
+    """
+    return os.path.join(backup_dir, f'{name}_{RUN_TIMESTAMP}.{extension}')
+
+class ChunkReader(io.RawIOBase):
+    """
+    Read-only file object over an iterable of byte chunks
+    """
+    def __init__(self, chunks: Iterable[bytes]):
+        super().__init__()
+        self.__chunks = iter(chunks)
+        self.__pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.__pending:
+            chunk = next(self.__chunks, None)
+            if chunk is None:
+                return 0
+            self.__pending = memoryview(chunk)
+
+        size = min(len(buffer), len(self.__pending))
+        buffer[:size] = self.__pending[:size]
+        self.__pending = self.__pending[size:]
+        return size
+
+@contextlib.contextmanager
+def partial_file(path: str):
+    """
+    Yield temporary path to write to, moved to path only if the block succeeds
+
+    A failed backup never replaces or looks like a finished one.
+    """
+    part = f"{path}.part"
+    try:
+        yield part
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+    os.replace(part, path)
+    logger.info('Wrote file: %s', path)
+
+class ExecStream:
+    """
+    Stdout chunks of a shell script run in a container, with its exit status
+    """
+    STDERR_LIMIT = 1 << 16
+
+    def __init__(self, container: Container, script: str):
+        api = client().api
+        self.__exec_id = api.exec_create(container.id, ["sh", "-c", script])["Id"]
+        self.__output = api.exec_start(self.__exec_id, stream=True, demux=True)
+        self.stderr = bytearray()
+
+    def __iter__(self):
+        for stdout, stderr in self.__output:
+            if stderr:
+                self.stderr.extend(stderr)
+                del self.stderr[:-self.STDERR_LIMIT]
+            if stdout:
+                yield stdout
+
+    def close(self):
+        """
+        Stop reading output
+        """
+        self.__output.close()
+
+    def check(self, what: str):
+        """
+        Raise RuntimeError if the script exited with a non-zero status
+        """
+        api = client().api
+        for _ in range(100):
+            result = api.exec_inspect(self.__exec_id)
+            if not result["Running"]:
+                break
+            time.sleep(0.1)
+        else:
+            raise RuntimeError(f"{what} did not finish after its output ended")
+
+        if result["ExitCode"] != 0:
+            message = self.stderr.decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"{what} failed with exit code {result['ExitCode']}: {message}")
+
+def write_stream(path: str, chunks: Iterable[bytes]):
+    """
+    Write each chunk to path as-is
     """
-    now = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    return os.path.join(backup_dir, f'{name}_{now}.{extension}')
+    with open(path, 'wb', buffering=CHUNK_SIZE) as file:
+        for chunk in chunks:
+            file.write(chunk)
 
-def write_compressed_file(path: str, data: bytes):
+def open_compressor(raw: io.IOBase, codec: str = "gz"):
     """
-    Compress and write data to path
+    Return writable file object compressing into raw with codec
     """
-    compressed_data = gzip.compress(data)
+    if codec == "zst":
+        return zstd.ZstdCompressor(level=ZSTD_LEVEL, threads=ZSTD_THREADS).stream_writer(raw)
 
-    with open(path, 'wb') as file:
-        file.write(compressed_data)
+    return gzip_impl.open(raw, 'wb', compresslevel=COMPRESS_LEVEL)
 
-    print(f'Wrote file: {path}')
+def write_compressed_stream(path: str, chunks: Iterable[bytes], codec: str = "gz"):
+    """
+    Compress and write each chunk to path as it arrives
+    """
+    with open(path, 'wb', buffering=CHUNK_SIZE) as raw, \
+            open_compressor(raw, codec) as file:
+        for chunk in chunks:
+            file.write(chunk)
+
+def gunzip_chunks(chunks: Iterable[bytes]):
+    """
+    Decompress a stream of gzip chunks
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    started = False
+    for chunk in chunks:
+        while chunk:
+            started = True
+            if output := decompressor.decompress(chunk):
+                yield output
+            chunk = b""
+            if decompressor.eof:
+                # Start over for the next gzip member, if any
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                started = False
+
+    if started:
+        raise ValueError("Truncated gzip stream")
+
+def write_transcoded_stream(path: str, chunks: Iterable[bytes], source: str, codec: str):
+    """
+    Write chunks compressed with source to path as codec
+    """
+    if source == codec:
+        write_stream(path, chunks)
+    elif source == "gz":
+        write_compressed_stream(path, gunzip_chunks(chunks), codec)
+    else:
+        write_compressed_stream(path, chunks, codec)
+
+def coalesce_chunks(chunks: Iterable[bytes], size: int = CHUNK_SIZE):
+    """
+    Join small chunks into buffers of at least size bytes
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer.extend(chunk)
+        if len(buffer) >= size:
+            yield buffer
+            buffer = bytearray()
+
+    if buffer:
+        yield buffer
+
+def prefetch_chunks(chunks: Iterable[bytes], maxsize: int = 16):
+    """
+    Pull chunks on a background thread so reading overlaps with consuming
+
+    Chunks are coalesced to CHUNK_SIZE first, so at most maxsize of those are
+    held in memory at once.
+    """
+    buffer = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _producer():
+        try:
+            for chunk in coalesce_chunks(chunks):
+                if not _put(chunk):
+                    return
+        except Exception as error: # pylint: disable=broad-except
+            _put(error)
+            return
+        _put(done)
+
+    threading.Thread(target=_producer, daemon=True).start()
+
+    try:
+        while (item := buffer.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            try:
+                close()
+            except ValueError:
+                # Producer is still inside next(); it exits once stop is seen
+                pass
+
+def write_dump(path: str, chunks: Iterable[bytes], codec: str = "gz"):
+    """
+    Write dump output to path with codec, compressing or transcoding it as needed
+    """
+    chunks = iter(chunks)
+    first = next((chunk for chunk in chunks if chunk), b"")
+    chunks = itertools.chain((first,), chunks)
+
+    source = next((name for name, magic in MAGIC.items() if first.startswith(magic)), None)
+    write_transcoded_stream(path, chunks, source, codec)
+
+def dump_compressed(container: Container, command: str, path: str, codec: str = "gz"):
+    """
+    Run command in container and write its compressed output to path
+
+    Compression happens inside the container so only compressed bytes cross
+    the docker socket. Containers without a suitable compressor have the raw
+    output compressed on the host instead. Picking the compressor happens in
+    the same exec as the dump so each call costs a single exec. The script
+    exits with the status of command rather than of the compressor.
+    """
+    script = COMPRESS_FUNCTIONS[codec] + f'''
+        st=$(mktemp) || exit 1
+        {{ {command}; echo $? > "$st"; }} | compress || exit 1
+        rc=$(cat "$st"); rm -f "$st"
+        exit "${{rc:-1}}"
+    '''
+    stream = ExecStream(container, script)
+    with partial_file(path) as part:
+        with contextlib.closing(prefetch_chunks(stream)) as chunks:
+            write_dump(part, chunks, codec)
+        stream.check(f"Dump of {container.name}")
 
 def delete_old_backups(backup_dir: str, max_days: int):
     """
@@ -64,46 +392,69 @@ def delete_old_backups(backup_dir: str, max_days: int):
     if max_days < 1:
         raise ValueError("Expected positive integer")
 
-    print(f'Looking for backups older than: {max_days} day{"" if max_days == 1 else "s"}')
-    for path in os.listdir(backup_dir):
-        path = os.path.join(backup_dir, path)
-        if not os.path.isfile(path):
-            continue
-        if time.time() - os.path.getmtime(path) <= max_days * 24 * 60 * 60:
-            continue
-
-        print(f'Deleted file: {path}')
-        os.remove(path)
+    logger.info('Looking for backups older than: %d day%s', max_days, "" if max_days == 1 else "s")
+    cutoff = time.time() - max_days * 24 * 60 * 60
+    with os.scandir(backup_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.stat().st_mtime >= cutoff:
+                continue
 
-    print()
+            logger.info('Deleted file: %s', entry.path)
+            os.remove(entry.path)
 
 
 class BackupStrategy(metaclass=abc.ABCMeta): # pylint: disable=too-few-public-methods
     """
     Abstract backup strategy
     """
-    def __init__(self, backup_dir: str, keywords=None):
-        self.containers = docker.from_env().containers.list()
+    def __init__(self, backup_dir: str, keywords=None, codec: str = DEFAULT_CODEC):
+        self.containers = all_containers()
         self.backup_dir = backup_dir
+        self.codec = resolve_codec(codec)
 
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
+        ensure_dir(backup_dir)
 
         self.__filter_containers(keywords)
 
     def __filter_containers(self, keywords: list[str]):
-        def __helper(container: Container):
-            for k in keywords:
-                if k in container.name:
-                    return True
-            return False
+        if not keywords:
+            self.containers = []
+            return
+
+        pattern = re.compile("|".join(map(re.escape, keywords)))
+        self.containers = [c for c in self.containers if pattern.search(c.name)]
+
+    def _run_parallel(self, fn):
+        """
+        Run fn for every container concurrently
 
-        self.containers = list(filter(__helper, self.containers))
+        A failure in one container is logged and does not stop the others.
+        Returns list of (container, exception) for the containers that failed.
+        """
+        if not self.containers:
+            return []
+
+        def _isolated(container: Container):
+            try:
+                fn(container)
+            except Exception as error: # pylint: disable=broad-except
+                logger.exception("Backup of %s failed", container.name)
+                return container, error
+            return None
+
+        max_workers = min(8, len(self.containers))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(_isolated, self.containers)
+            return [result for result in results if result is not None]
 
     @abc.abstractmethod
     def execute(self):
         """
         Execute backup solution
+
+        Returns list of (container, exception) for the containers that failed.
         """
         raise NotImplementedError()
 
@@ -114,46 +465,99 @@ class MySQLBackup(BackupStrategy): # pylint: disable=too-few-public-methods
     """
     keywords = ["mysql", "mariadb"]
 
-    def __init__(self, backup_dir: str,keywords=None):
+    def __init__(self, backup_dir: str,keywords=None, codec: str = DEFAULT_CODEC):
         super().__init__(
-            backup_dir, merge_keywords(self.keywords, keywords)
+            backup_dir, merge_keywords(self.keywords, keywords), codec
         )
 
     def execute(self):
-        for container in self.containers:
+        def _backup_one(container: Container):
             env = parse_env(container)
-            output = container.exec_run(
-                f'/usr/bin/mysqldump ' \
-                f'{env.get("MYSQL_DATABASE")} -u root -p{env.get("MYSQL_ROOT_PASSWORD")}'
-            ).output
+            database = env.get("MYSQL_DATABASE", "")
+            password = env.get("MYSQL_ROOT_PASSWORD", "")
+            command = f'/usr/bin/mysqldump {shlex.quote(database)} -u root'
+            if password:
+                command += f' -p{shlex.quote(password)}'
 
             path = format_file_path(self.backup_dir,
-                                    f'{container.name}_{env.get("MYSQL_DATABASE")}',
-                                    'sql.gz')
-            write_compressed_file(path, output)
-            print()
+                                    f'{container.name}_{database}',
+                                    f'sql.{self.codec}')
+            dump_compressed(container, command, path, self.codec)
+
+        return self._run_parallel(_backup_one)
 
 
 class SQLiteGeneric(BackupStrategy, metaclass=abc.ABCMeta): # pylint: disable=too-few-public-methods
     """
-    Generic SQLite backup to provide method for individual database files
+    Generic SQLite backup to provide method for database files
     """
-    def backup_database(self, container: Container, path: str):
+    def backup_databases(self, container: Container, directory: str, extension: str):
         """
-        Backup sqlite db file at path of container
-        """
-        output = container.exec_run(
-            f'/usr/bin/sqlite3 {path} .dump'
-        ).output
-
-        file_name = os.path.basename(path)
-        if "." in file_name:
-            file_name = file_name.split(".")[0]
+        Backup every sqlite db file matching directory/*.extension of container
 
+        All files are dumped by a single exec and sqlite3 process, compressed as
+        they are dumped, and returned as a tar stream.
+        """
+        pattern = f"{shlex.quote(directory.rstrip('/') or '/')}/*.{shlex.quote(extension)}"
+        script = COMPRESS_FUNCTIONS[self.codec] + f'''
+            d=$(mktemp -d) || exit 1
+            trap 'rm -rf "$d"' EXIT
+            if [ ! -x /usr/bin/sqlite3 ]; then
+                echo "/usr/bin/sqlite3 not found" >&2
+                exit 1
+            fi
+            mkdir "$d/out" || exit 1
+            for f in {pattern}; do
+                [ -f "$f" ] || continue
+                case "$f" in
+                    *[\\'\\"\\\\\\$\\`]*)
+                        echo "Refusing to dump path with quotes: $f" >&2
+                        exit 1;;
+                esac
+                n=$(basename "$f")
+                # The query makes -bail stop on files that are not databases,
+                # which .dump alone only reports inside its output
+                printf ".open '%s'\\n.output /dev/null\\nSELECT count(*) FROM sqlite_master;\\n" "$f"
+                printf ".output '|%s > \\"%s\\" || : > \\"%s\\"'\\n.dump\\n" \\
+                    "$zcmd" "$d/out/${{n%%.*}}.sql$sfx" "$d/failed"
+            done > "$d/commands" || exit 1
+            if [ ! -s "$d/commands" ]; then
+                echo "No databases matching {pattern}" >&2
+                exit 1
+            fi
+            /usr/bin/sqlite3 -bail < "$d/commands" || exit 1
+            if [ -e "$d/failed" ]; then
+                echo "$zcmd failed" >&2
+                exit 1
+            fi
+            tar -C "$d/out" -cf - . || exit 1
+        '''
+        stream = ExecStream(container, script)
+
+        try:
+            with contextlib.closing(prefetch_chunks(stream)) as output, \
+                    tarfile.open(fileobj=ChunkReader(output), mode="r|") as archive:
+                for member in archive:
+                    if member.isfile():
+                        self.__write_member(container, archive, member)
+        except tarfile.ReadError:
+            # Prefer the script's own error over the resulting broken archive
+            stream.check(f"Database dump of {container.name}")
+            raise
+
+        stream.check(f"Database dump of {container.name}")
+
+    def __write_member(self, container: Container, archive: tarfile.TarFile,
+                       member: tarfile.TarInfo):
+        file_name = os.path.basename(member.name).split(".")[0]
         backup_path = format_file_path(self.backup_dir,
                                 f'{container.name}_{file_name}',
-                                'sql.gz')
-        write_compressed_file(backup_path, output)
+                                f'sql.{self.codec}')
+        file = archive.extractfile(member)
+        chunks = iter(functools.partial(file.read, CHUNK_SIZE), b"")
+        source = next((name for name in MAGIC if member.name.endswith(f".{name}")), None)
+        with partial_file(backup_path) as part:
+            write_transcoded_stream(part, chunks, source, self.codec)
 
 
 class JellyfinBackup(SQLiteGeneric):
@@ -164,23 +568,16 @@ class JellyfinBackup(SQLiteGeneric):
     db_path = "/config/data"
     db_ext = "db"
 
-    def __init__(self, backup_dir: str,keywords=None):
+    def __init__(self, backup_dir: str,keywords=None, codec: str = DEFAULT_CODEC):
         super().__init__(
-            backup_dir, merge_keywords(self.keywords, keywords)
+            backup_dir, merge_keywords(self.keywords, keywords), codec
         )
 
     def execute(self):
-        ls_path = os.path.join(self.db_path, f"*.{self.db_ext}")
-        for container in self.containers:
-            ls_result = container.exec_run(f'bash -c "ls {ls_path}"')
-            ls_output = ls_result.output.decode("utf-8").strip()
-            if ls_result.exit_code != 0:
-                print(f"ls failed with exit code {ls_result.exit_code}: {ls_output}")
-                return
-
-            for path in ls_output.split("\n"):
-                self.backup_database(container, path)
-        print()
+        def _backup_one(container: Container):
+            self.backup_databases(container, self.db_path, self.db_ext)
+
+        return self._run_parallel(_backup_one)
 
 
 class RadarrBackup(JellyfinBackup):
@@ -1,10 +1,14 @@
 #!/usr/bin/python3
 # pylint: disable=missing-module-docstring
 
+import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import docker_backup
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     if len(sys.argv) < 3:
         print("Missing arguments!")
         print("Usage: main.py <backup_dir> <max_days>")
@@ -17,11 +21,25 @@ if __name__ == "__main__":
         print("<max_days> must be a positive non-zero integer!")
         sys.exit(1)
 
-    docker_backup.MySQLBackup(PATH).execute()
-    docker_backup.JellyfinBackup(PATH).execute()
-    docker_backup.RadarrBackup(PATH).execute()
-    docker_backup.SonarrBackup(PATH).execute()
-    docker_backup.GrocyBackup(PATH).execute()
-    docker_backup.DuplicatiBackup(PATH).execute()
+    STRATEGIES = [
+        docker_backup.MySQLBackup(PATH),
+        docker_backup.JellyfinBackup(PATH),
+        docker_backup.RadarrBackup(PATH),
+        docker_backup.SonarrBackup(PATH),
+        docker_backup.GrocyBackup(PATH),
+        docker_backup.DuplicatiBackup(PATH),
+    ]
+
+    with ThreadPoolExecutor(max_workers=len(STRATEGIES)) as executor:
+        FAILURES = [
+            failure
+            for failures in executor.map(lambda strategy: strategy.execute(), STRATEGIES)
+            for failure in failures
+        ]
+
+    if FAILURES:
+        logging.error("%d backup%s failed, keeping old backups",
+                      len(FAILURES), "" if len(FAILURES) == 1 else "s")
+        sys.exit(1)
 
     docker_backup.delete_old_backups(PATH, MAX_DAYS)